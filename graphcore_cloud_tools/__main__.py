@@ -3,11 +3,14 @@
 _MISSING_REQUIREMENTS = {}
 import argparse
 import sys
+from typing import List, Optional
 
 from .paperspace_utils import paperspace_parser, run_paperspace
 
 
-def main(raw_args):
+def main(raw_args: Optional[List[str]] = None):
+    if raw_args is None:
+        raw_args = sys.argv
     parser = argparse.ArgumentParser()
 
     subparsers = parser.add_subparsers(dest="subparser")
@@ -29,4 +32,4 @@ def main(raw_args):
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    main()
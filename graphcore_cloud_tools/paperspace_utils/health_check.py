@@ -2,14 +2,14 @@
 from datetime import datetime
 import json
 import os
-import yaml
 import logging
 import pathlib
 from .metadata_utils import check_files_match_metadata
+from .symlink_datasets_and_caches import read_gradient_settings
 from pathlib import Path
 from time import time
 import argparse
-from typing import List
+from typing import List, Optional
 
 
 def check_datasets_exist(dataset_names: [str], dirname: str):
@@ -56,7 +56,7 @@ def check_paths_exists(paths: List[str]):
     return symlinks_exist
 
 
-def parse_args(parser: argparse.ArgumentParser):
+def parse_args(parser: argparse.ArgumentParser, raw_args: Optional[List[str]] = None):
     parser.add_argument(
         "--log-folder",
         default="/storage/graphcore_health_checks",
@@ -73,7 +73,7 @@ def parse_args(parser: argparse.ArgumentParser):
         help="Path to symlink_config.json file",
     )
     parser.add_argument("--dataset-folder", default="/datasets", help="Path to dataset folder")
-    return parser.parse_args()
+    return parser.parse_args(raw_args)
 
 
 def run_health_check(args):
@@ -89,9 +89,7 @@ def run_health_check(args):
     logging.info("Checking datasets mounted")
     # Check that the datasets have mounted as expected
     # Gather the datasets expected from the settings.yaml
-    with open(args.gradient_settings_file) as f:
-        my_dict = yaml.safe_load(f)
-        datasets = my_dict["integrations"].keys()
+    datasets = read_gradient_settings(args.gradient_settings_file)
 
     # Check that dataset exists and if a metadata file is found check that all files in the metadata file exist
     datasets_mounted = check_datasets_exist(datasets, args.dataset_folder)
@@ -16,14 +16,18 @@ import datetime
 
 
 METADATA_FILENAME = "gradient_dataset_metadata.json"
+HASH_CHUNK_SIZE = 1024**2
 
 
 # Copied from paperspace_automation upload script
 def md5_hash_file(file_path: Path):
-    md5 = hashlib.md5()
+    # Hash the file in chunks rather than reading it whole, dataset files can be many GB
     with open(file_path, "rb") as f:
-        data = f.read()
-        md5.update(data)
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "md5").hexdigest()
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
     return md5.hexdigest()
 
 
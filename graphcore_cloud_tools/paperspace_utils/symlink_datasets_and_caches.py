@@ -6,31 +6,65 @@ from pathlib import Path
 import subprocess
 import os
 import warnings
-from typing import List, NamedTuple, Dict, Optional, Tuple
+from typing import Iterator, List, NamedTuple, Dict, Optional, Tuple
 import base64
+import contextlib
+import http.client
+import ctypes
+import ctypes.util
 import itertools
 import time
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
 import random
+import re
+import shutil
+import socket
+import threading
+import urllib.error
+import urllib.request
 import boto3
+import botocore.config
+import botocore.exceptions
 from boto3.s3.transfer import TransferConfig
+from s3transfer.manager import TransferManager
 import argparse
 import logging
 import yaml
 
 from .auth import AWS_CREDENTIAL_ENV_VAR, DEFAULT_S3_CREDENTIAL
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 
 # environment variables which can be used to configure the execution of the program
 DATASET_METHOD_OVERRIDE_ENV_VAR = "USE_LEGACY_DATASET_SYMLINK"
 LEGACY_DATASET_ENV_VAR = "PUBLIC_DATASETS_DIR"
 FUSEOVERLAY_ROOT_ENV_VAR = "SYMLINK_FUSE_ROOTDIR"  # must be a writeable directory
+KERNEL_OVERLAY_ENV_VAR = "SYMLINK_KERNEL_OVERLAY"  # set to 0 to always use fuse-overlayfs, even as root
 S3_DATASETS_DIR_ENV_VAR = "S3_DATASETS_DIR"  # must be a writeable directory with space to download all requested files
 DEFAULT_S3_DATASET_DIR = "/graphcore-gradient-datasets"
 AWS_ENDPOINT_ENV_VAR = "DATASET_S3_DOWNLOAD_ENDPOINT"  # A list of semi-colon separated endpoints to cycle between
 DEFAULT_AWS_ENDPOINT = "http://10.12.17.91:8100"  # The S3 endpoint for Paperspace
 
 S3_DATASET_FOLDER = "graphcore-gradient-datasets"
+DATASET_MOUNT_TIMEOUT_SECONDS = 300
+
+MB = 1024**2
+# S3 transfer settings, larger parts and reads than the boto3 defaults (8MB and 256KB)
+# make fewer requests and syscalls per GB on the high bandwidth links to the S3 endpoints
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * MB
+DEFAULT_IO_CHUNKSIZE = 1 * MB
+# S3 transfer settings of the AWS CLI when none are configured
+CLI_DEFAULT_MAX_CONCURRENT_REQUESTS = 10
+CLI_DEFAULT_MULTIPART_CHUNKSIZE = 8 * MB
+# Chunks waiting to be written to disk are held in memory, bound their total size when the disk is
+# slower than the network. The boto3 default queue of 100 chunks of 256KB holds 25MB.
+IO_QUEUE_MEMORY_BUDGET = 100 * MB
 
 
 class MissingDataset(Exception):
@@ -41,28 +75,87 @@ class S3DownloadFailed(Exception):
     pass
 
 
+def wait_for_directory_change(inotify: Optional["INotify"], directory: Path, timeout: float):
+    """Waits for `timeout` seconds, returning early when an entry is created in `directory` or its parent
+
+    Without `inotify_simple` installed, or if the folders cannot be watched, this sleeps for the whole `timeout`.
+    """
+    if inotify is None:
+        time.sleep(timeout)
+        return
+    try:
+        for path in (directory.parent, directory):
+            if path.is_dir():
+                inotify.add_watch(path, inotify_flags.CREATE | inotify_flags.MOVED_TO)
+    except OSError as error:
+        # The limit on the number of watches may be reached
+        logging.debug(f"Could not watch {directory} for changes, polling instead: {error}")
+        time.sleep(timeout)
+        return
+    inotify.read(timeout=int(timeout * 1000))
+
+
+def create_inotify() -> Optional["INotify"]:
+    """Returns an inotify instance, or None if `inotify_simple` is not installed or inotify is not available"""
+    if INotify is None:
+        return None
+    try:
+        return INotify()
+    except OSError as error:
+        # Raised when the limit on inotify instances is reached or in containers which do not provide it
+        logging.debug(f"inotify is not available, polling for datasets instead: {error}")
+        return None
+
+
 def check_dataset_is_mounted(source_dirs_list: List[str]) -> List[str]:
     source_dirs_exist_paths = []
-    for source_dir in source_dirs_list:
-        source_dir_path = Path(source_dir)
-        COUNTER = 0
-        # wait until the dataset exists and is populated/non-empty, with a 300s/5m timeout
-        while (COUNTER < 300) and (not source_dir_path.exists() or not any(source_dir_path.iterdir())):
-            print(f"Waiting for dataset {source_dir_path.as_posix()} to be mounted...")
-            time.sleep(1)
-            COUNTER += 1
-
-        if COUNTER == 300:
-            warnings.warn(
-                f"Abandoning symlink! - source dataset {source_dir} has not been mounted & populated after 5 minutes."
-            )
-        else:
-            print(f"Found dataset {source_dir}")
-            source_dirs_exist_paths.append(source_dir)
+    inotify = create_inotify()
+    try:
+        for source_dir in source_dirs_list:
+            source_dir_path = Path(source_dir)
+            # wait until the dataset exists and is populated/non-empty, with a 300s/5m timeout
+            deadline = time.monotonic() + DATASET_MOUNT_TIMEOUT_SECONDS
+            mounted = source_dir_path.exists() and any(source_dir_path.iterdir())
+            while not mounted and time.monotonic() < deadline:
+                print(f"Waiting for dataset {source_dir_path.as_posix()} to be mounted...")
+                # Mounting a dataset does not raise inotify events, so keep checking at least every second
+                wait_for_directory_change(inotify, source_dir_path, max(0, min(1, deadline - time.monotonic())))
+                mounted = source_dir_path.exists() and any(source_dir_path.iterdir())
+
+            if not mounted:
+                warnings.warn(
+                    f"Abandoning symlink! - source dataset {source_dir} has not been mounted & populated after 5 minutes."
+                )
+            else:
+                print(f"Found dataset {source_dir}")
+                source_dirs_exist_paths.append(source_dir)
+    finally:
+        if inotify is not None:
+            inotify.close()
 
     return source_dirs_exist_paths
 
 
+def mount_kernel_overlay(options: str, target_dir: str) -> subprocess.CompletedProcess:
+    """Mounts an overlay filesystem with the mount system call, which needs root privileges
+
+    The result mimics the equivalent `mount` command so it can be handled like the fuse-overlayfs one.
+    """
+    args = ["mount", "-t", "overlay", "overlay", "-o", options, target_dir]
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mount(b"overlay", target_dir.encode(), b"overlay", 0, options.encode()) != 0:
+        errno = ctypes.get_errno()
+        return subprocess.CompletedProcess(args, errno, stdout=f"mount: {os.strerror(errno)}")
+    return subprocess.CompletedProcess(args, 0, stdout="")
+
+
+def walk_paths(root: Path) -> Iterator[str]:
+    """Yields every folder and file below `root`, like `root.rglob("*")` without building a Path per entry"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in itertools.chain(dirnames, filenames):
+            yield os.path.join(dirpath, name)
+
+
 def create_overlays(source_dirs_exist_paths: List[str], target_dir: str) -> subprocess.CompletedProcess:
     print(f"Symlinking - {source_dirs_exist_paths} to {target_dir}")
     print("-" * 100)
@@ -76,7 +169,14 @@ def create_overlays(source_dirs_exist_paths: List[str], target_dir: str) -> subp
     upperdir.mkdir(parents=True, exist_ok=True)
 
     lowerdirs = ":".join(source_dirs_exist_paths)
-    overlay_command = f"fuse-overlayfs -o lowerdir={lowerdirs},upperdir={upperdir.as_posix()},workdir={workdir.as_posix()} {target_dir}"
+    options = f"lowerdir={lowerdirs},upperdir={upperdir.as_posix()},workdir={workdir.as_posix()}"
+    # The kernel overlay avoids starting a fuse-overlayfs process and serving every read through FUSE
+    if os.geteuid() == 0 and os.getenv(KERNEL_OVERLAY_ENV_VAR, "1") != "0":
+        out = mount_kernel_overlay(options, target_dir)
+        if out.returncode == 0:
+            return out
+        logging.debug(f"Kernel overlay mount of {target_dir} failed, falling back to fuse-overlayfs: {out.stdout}")
+    overlay_command = f"fuse-overlayfs -o {options} {target_dir}"
     out = subprocess.run(
         overlay_command.split(),
         stdout=subprocess.PIPE,
@@ -87,7 +187,11 @@ def create_overlays(source_dirs_exist_paths: List[str], target_dir: str) -> subp
 
 
 def symlink_gradient_datasets(args):
-    """Symlink gradient datasets using fuse-overlayfs"""
+    """Symlink gradient datasets using overlay filesystems
+
+    The kernel overlayfs is used when running as root, unless disabled with the `SYMLINK_KERNEL_OVERLAY`
+    environment variable, fuse-overlayfs is used otherwise or if the kernel mount fails.
+    """
     # read in symlink config file
     json_data = Path(args.config_file).read_text()
 
@@ -110,17 +214,17 @@ def symlink_gradient_datasets(args):
         target_path = Path(target_dir).resolve()
         for source_path in source_dirs_exist_paths:
             source_path = Path(source_path).resolve()
-            expected_paths.extend(
-                [str((target_path / f.relative_to(source_path)).resolve()) for f in source_path.rglob("*")]
-            )
+            source_len = len(str(source_path))
+            expected_paths.extend(f"{target_path}{path[source_len:]}" for path in walk_paths(source_path))
         if len(source_dirs_exist_paths) > 0:
             out = create_overlays(source_dirs_exist_paths, target_dir)
         symlink_results.append((target_dir, out))
-        found_target_paths.extend([str(f) for f in target_path.rglob("*")])
+        found_target_paths.extend(walk_paths(target_path))
     errors = [f"{t} failed with error: {o}" for t, o in symlink_results if isinstance(o, str) or o.returncode != 0]
     if errors:
         raise RuntimeError("\n".join(errors))
-    missing_files = [e for e in expected_paths if e not in found_target_paths]
+    found_target_paths_set = set(found_target_paths)
+    missing_files = [e for e in expected_paths if e not in found_target_paths_set]
     if missing_files:
         raise FileNotFoundError(
             "The symlink config was not applied correctly, some files could not be found in their expected location.\n"
@@ -131,23 +235,35 @@ def symlink_gradient_datasets(args):
         )
 
 
+def check_aws_endpoint(aws_endpoint: str, timeout: float = 5) -> bool:
+    """Checks if the endpoint answers HTTP requests, any response status means it can be used"""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(aws_endpoint, method="HEAD"), timeout=timeout):
+            pass
+    except urllib.error.HTTPError:
+        # The endpoint answered, the status of the response does not matter
+        pass
+    except (OSError, http.client.HTTPException) as error:
+        # Unreachable endpoints raise URLError or socket errors, which are OSErrors,
+        # endpoints which break the HTTP protocol raise HTTPException
+        reason = getattr(error, "reason", error)
+        if isinstance(reason, (socket.timeout, TimeoutError)):
+            print(f"End point could not be reached: {aws_endpoint}")
+        else:
+            print(f"End point cannot be reached from current executor: {aws_endpoint}")
+        return False
+    print(f"Validated endpoint: {aws_endpoint}")
+    return True
+
+
 def get_valid_aws_endpoints(endpoint_fallback=False) -> List[str]:
     # Check which endpoint should be used based on if we can directly access or not
     AWS_ENDPOINT = os.getenv(AWS_ENDPOINT_ENV_VAR, DEFAULT_AWS_ENDPOINT)
     aws_endpoints = AWS_ENDPOINT.split(";")
-    valid_aws_endpoints = []
-    for aws_endpoint in aws_endpoints:
-        try:
-            subprocess.check_output(["curl", aws_endpoint], timeout=5)
-            print(f"Validated endpoint: {aws_endpoint}")
-            valid_aws_endpoints.append(aws_endpoint)
-        except subprocess.TimeoutExpired:
-            print(f"End point could not be reached: {aws_endpoint}")
-        except subprocess.CalledProcessError as error:
-            if "exit status 7" in f"{error}":
-                print(f"End point cannot be reached from current executor: {aws_endpoint}")
-            else:
-                raise
+    # Check all the endpoints at once so unreachable ones cost a single timeout in total
+    with ThreadPoolExecutor(max_workers=len(aws_endpoints)) as executor:
+        reachable = list(executor.map(check_aws_endpoint, aws_endpoints))
+    valid_aws_endpoints = [aws_endpoint for aws_endpoint, ok in zip(aws_endpoints, reachable) if ok]
     if not valid_aws_endpoints:
         if not endpoint_fallback:
             raise ValueError(
@@ -160,8 +276,24 @@ def get_valid_aws_endpoints(endpoint_fallback=False) -> List[str]:
     return valid_aws_endpoints
 
 
-def prepare_cred() -> None:
-    """Decode and write AWS read credential to file"""
+def cli_profile_section(max_concurrent_requests: int) -> str:
+    """The AWS CLI config section of the 'gcdata-r' profile, settings below the CLI defaults are left out"""
+    settings = {}
+    if max_concurrent_requests > CLI_DEFAULT_MAX_CONCURRENT_REQUESTS:
+        settings["max_concurrent_requests"] = str(max_concurrent_requests)
+    if DEFAULT_MULTIPART_CHUNKSIZE > CLI_DEFAULT_MULTIPART_CHUNKSIZE:
+        settings["multipart_chunksize"] = f"{DEFAULT_MULTIPART_CHUNKSIZE // MB}MB"
+    if not settings:
+        return ""
+    return "[profile gcdata-r]\ns3 =\n" + "".join(f"    {key} = {value}\n" for key, value in settings.items())
+
+
+def prepare_cred(cli_max_concurrent_requests: Optional[int] = None) -> None:
+    """Decode and write AWS read credential to file
+
+    When `cli_max_concurrent_requests` is set the S3 transfer settings of each AWS CLI process are also
+    written for the credential's profile, replacing the ones written by a previous run.
+    """
     aws_credential = os.getenv(AWS_CREDENTIAL_ENV_VAR)
     read_only = aws_credential if aws_credential else DEFAULT_S3_CREDENTIAL
     cred_bytes = base64.b64decode(read_only)
@@ -175,6 +307,22 @@ def prepare_cred() -> None:
         logging.debug(f"Credential 'gcdata-r' written to {creds_file}")
     else:
         logging.debug(f"Credential 'gcdata-r' found in credential file: {creds_file}")
+    if cli_max_concurrent_requests is None:
+        return
+    config_file = creds_file.parent / "config"
+    config_file.touch(exist_ok=True)
+    config = config_file.read_text()
+    # The profile's section runs until the next section header
+    existing = re.search(r"^\[profile gcdata-r\]\n(?:(?!\[).*(?:\n|$))*", config, flags=re.MULTILINE)
+    section = cli_profile_section(cli_max_concurrent_requests)
+    if (existing.group(0) if existing else "") == section:
+        return
+    if existing:
+        config = config[: existing.start()] + config[existing.end() :]
+    if section:
+        config = f"{config.rstrip()}\n\n{section}".lstrip()
+    config_file.write_text(config)
+    logging.debug(f"CLI settings for profile 'gcdata-r' written to {config_file}")
 
 
 def encode_cred(plain_text_cred: str) -> str:
@@ -186,46 +334,57 @@ class GradientDatasetFile(NamedTuple):
     s3file: str
     local_file: str
     size: int = 0
+    last_modified: float = 0  # POSIX timestamp of the object's last modification in S3, 0 if unknown
 
     @classmethod
-    def from_response(cls, s3_response: dict):
-        bucket_name: str = f"s3://{s3_response['Name']}"
+    def from_response(cls, s3_response: dict) -> Iterator["GradientDatasetFile"]:
         s3_prefix = s3_response["Prefix"]
         local_root = os.getenv(S3_DATASETS_DIR_ENV_VAR, DEFAULT_S3_DATASET_DIR)
-        for pre in s3_prefix.split("/"):
-            if pre not in local_root:
-                local_root = f"{local_root}/{pre}"
-        print(local_root)
-        if "/" != bucket_name[-1]:
-            bucket_name = f"{bucket_name}/"
-
-        def single_entry(s3_content_response: dict):
-            s3_object_name: str = s3_content_response["Key"]
-            relative_file = s3_object_name.replace(s3_prefix, "").strip("/")
-            target = Path(local_root).resolve() / relative_file
-            return cls(
-                s3file=s3_object_name,
-                local_file=str(target),
-                size=s3_content_response.get("Size", 0),
+        # The local root may already end with the leading components of the prefix (the S3 dataset
+        # folder by default), only the components which do not overlap with its tail are appended
+        local_root_parts = [part for part in local_root.split("/") if part]
+        prefix_parts = [part for part in s3_prefix.split("/") if part]
+        overlap = next(
+            n
+            for n in range(min(len(local_root_parts), len(prefix_parts)), -1, -1)
+            if n == 0 or local_root_parts[-n:] == prefix_parts[:n]
+        )
+        for pre in prefix_parts[overlap:]:
+            local_root = f"{local_root}/{pre}"
+        logging.debug(f"Local root for prefix '{s3_prefix}': {local_root}")
+        # Resolve once, resolving for every entry costs a stat per path component
+        root_resolved = Path(local_root).resolve()
+        # Every key returned for the prefix starts with it, slice it off instead of searching for it
+        prefix_len = len(s3_prefix.rstrip("/")) + 1
+        for content in s3_response["Contents"]:
+            yield cls(
+                s3file=content["Key"],
+                local_file=str(root_resolved / content["Key"][prefix_len:]),
+                size=content.get("Size", 0),
+                last_modified=content["LastModified"].timestamp() if "LastModified" in content else 0,
             )
 
-        return [single_entry(c) for c in s3_response["Contents"]]
 
-
-def list_files(client: "boto3.Client", dataset_name: str) -> List[GradientDatasetFile]:
+def list_files(client: "boto3.Client", dataset_name: str) -> Iterator[GradientDatasetFile]:
+    """Yields the files of a dataset page by page, so downloads can start before the listing completes"""
     dataset_prefix = f"{S3_DATASET_FOLDER}/{dataset_name}/"
-    out = client.list_objects_v2(Bucket="sdk", MaxKeys=10000, Prefix=dataset_prefix)
-    assert out["ResponseMetadata"].get("HTTPStatusCode", 200) == 200, "Response did not have HTTPS status 200"
-    assert not out["IsTruncated"], "Handling of truncated response is not handled yet"
-    if "Contents" not in out:
+    pages = client.get_paginator("list_objects_v2").paginate(
+        Bucket="sdk", Prefix=dataset_prefix, PaginationConfig={"PageSize": 1000}
+    )
+    found_files = False
+    for out in pages:
+        assert out["ResponseMetadata"].get("HTTPStatusCode", 200) == 200, "Response did not have HTTPS status 200"
+        logging.debug(f"S3 response {out}")
+        if out.get("Contents"):
+            found_files = True
+            yield from GradientDatasetFile.from_response(out)
+    if not found_files:
         raise MissingDataset(f"Dataset '{dataset_name}' not found at 's3://sdk/{dataset_prefix}'")
-    logging.debug(f"S3 response {out}")
-    return GradientDatasetFile.from_response(out)
 
 
-def apply_symlink(
-    list_files: List[GradientDatasetFile], directory_map: Dict[str, List[str]]
-) -> List[GradientDatasetFile]:
+def symlink_source_target(directory_map: Dict[str, List[str]]) -> Dict[str, str]:
+    """Inverts the symlink config into a mapping from each source folder to its target folder"""
+
     def with_trailing_slash(path):
         return path if path[-1] == "/" else f"{path}/"
 
@@ -235,14 +394,105 @@ def apply_symlink(
         for source in sources
     }
     logging.debug(f"Mapping used for symling: {source_target}")
-    symlinked_list = []
-    for file in list_files:
-        local_file = file.local_file
-        for source, new_root in source_target.items():
-            if source in local_file:
-                local_file = local_file.replace(source, new_root)
-        symlinked_list.append(file._replace(local_file=local_file))
-    return symlinked_list
+    return source_target
+
+
+def symlink_file(file: GradientDatasetFile, source_target: Dict[str, str]) -> GradientDatasetFile:
+    local_file = file.local_file
+    for source, new_root in source_target.items():
+        if source in local_file:
+            local_file = local_file.replace(source, new_root)
+    return file._replace(local_file=local_file)
+
+
+def apply_symlink(
+    list_files: List[GradientDatasetFile], directory_map: Dict[str, List[str]]
+) -> List[GradientDatasetFile]:
+    source_target = symlink_source_target(directory_map)
+    return [symlink_file(file, source_target) for file in list_files]
+
+
+_S3_CLIENTS: Dict[Tuple[str, str, int], "boto3.Client"] = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+
+
+def get_s3_client(aws_endpoint: str, aws_credential: str, max_pool_connections: int = 10) -> "boto3.Client":
+    """Returns an S3 client for the endpoint which is shared by all the downloads using it
+
+    Clients are thread safe but sessions are not, so they are created under a lock and cached
+    to avoid re-reading the credentials and opening a new connection pool for every file.
+    """
+    key = (aws_endpoint, aws_credential, max_pool_connections)
+    with _S3_CLIENTS_LOCK:
+        if key not in _S3_CLIENTS:
+            _S3_CLIENTS[key] = boto3.Session(profile_name=aws_credential).client(
+                "s3",
+                endpoint_url=aws_endpoint,
+                config=botocore.config.Config(max_pool_connections=max_pool_connections),
+            )
+        return _S3_CLIENTS[key]
+
+
+def build_transfer_config(
+    max_concurrency: int,
+    multipart_threshold: int = DEFAULT_MULTIPART_THRESHOLD,
+    multipart_chunksize: int = DEFAULT_MULTIPART_CHUNKSIZE,
+    io_chunksize: int = DEFAULT_IO_CHUNKSIZE,
+) -> TransferConfig:
+    """Files below the multipart threshold are fetched with a single GET, larger files
+    are fetched as concurrent ranged GETs of `multipart_chunksize` bytes"""
+    return TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        io_chunksize=io_chunksize,
+        max_concurrency=max_concurrency,
+        max_io_queue=max(1, IO_QUEUE_MEMORY_BUDGET // io_chunksize),
+        num_download_attempts=5,
+    )
+
+
+# Error codes which every other download from the same endpoint will hit as well
+FATAL_S3_ERROR_CODES = {
+    "AccessDenied",
+    "InvalidAccessKeyId",
+    "SignatureDoesNotMatch",
+    "ExpiredToken",
+    "403",
+    "Forbidden",
+}
+# HEAD requests have no body to carry an error code, a rejected HeadObject only reports its status
+FATAL_S3_HTTP_STATUS_CODES = {401, 403}
+
+
+def is_fatal_download_error(error: Exception) -> bool:
+    """Authentication errors are not specific to a file, retrying other files is wasted bandwidth"""
+    if isinstance(error, botocore.exceptions.NoCredentialsError):
+        return True
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return code in FATAL_S3_ERROR_CODES or status in FATAL_S3_HTTP_STATUS_CODES
+    return False
+
+
+def download_small_file(s3client, bucket_name: str, key: str, target: Path, io_chunksize: int = DEFAULT_IO_CHUNKSIZE):
+    """Objects below the multipart threshold are fetched with a single GET, which is issued directly
+    on the calling thread instead of going through the transfer manager's submission queue and worker threads"""
+    body = s3client.get_object(Bucket=bucket_name, Key=key)["Body"]
+    with open(target, "wb") as f:
+        shutil.copyfileobj(body, f, io_chunksize)
+
+
+def is_downloaded(target: Path, file: GradientDatasetFile) -> bool:
+    """Like `aws s3 sync`, a local file is up to date if it has the size of the object and is not older than it
+
+    The AWS CLI sets the modification time of the files it downloads to the one of the object.
+    """
+    try:
+        stat = target.stat()
+    except FileNotFoundError:
+        return False
+    return stat.st_size == file.size and stat.st_mtime >= file.last_modified
 
 
 class DownloadOutput(NamedTuple):
@@ -251,14 +501,17 @@ class DownloadOutput(NamedTuple):
     errors: Optional[List[Exception]]
 
 
-def download_file_iterate_endpoints(aws_endpoints: List[str], *args, **kwargs) -> DownloadOutput:
+def download_file_iterate_endpoints(
+    aws_endpoints: List[str], *args, transfer_managers: Optional[Dict[str, TransferManager]] = None, **kwargs
+) -> DownloadOutput:
     # Randomly shuffles endpoints to load balance
     aws_endpoints = aws_endpoints.copy()
     random.shuffle(aws_endpoints)
+    transfer_managers = transfer_managers or {}
     error_in_loop = []
     for aws_endpoint in aws_endpoints:
         try:
-            return download_file(aws_endpoint, *args, **kwargs)
+            return download_file(aws_endpoint, *args, transfer_manager=transfer_managers.get(aws_endpoint), **kwargs)
         except Exception as error:
             error_in_loop.append((aws_endpoint, error))
             logging.error("endpoint %s failed with error: %s", aws_endpoint, error)
@@ -281,20 +534,45 @@ def download_file(
     use_cli,
     progress="",
     max_attempts=2,
+    max_pool_connections=10,
+    transfer_manager: Optional[TransferManager] = None,
+    make_parent_dirs=True,
+    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+    io_chunksize=DEFAULT_IO_CHUNKSIZE,
 ) -> DownloadOutput:
     bucket_name = "sdk"
-    s3client = boto3.Session(profile_name=aws_credential).client("s3", endpoint_url=aws_endpoint)
-    print(f"Downloading {progress} {file}")
+    progress = f" {progress}" if progress else ""
+    print(f"Downloading{progress} {file}")
     start = time.time()
-    config = TransferConfig(max_concurrency=max_concurrency)
+    # Downloads share the transfer manager of their endpoint when one is provided,
+    # otherwise a manager is created for this file only.
+    small_file = not use_cli and 0 < file.size < multipart_threshold
+    if small_file:
+        if transfer_manager is not None:
+            s3client = transfer_manager.client
+        else:
+            s3client = get_s3_client(aws_endpoint, aws_credential, max_pool_connections)
+    owned_transfer_manager = None
+    if transfer_manager is None and not use_cli and not small_file:
+        s3client = get_s3_client(aws_endpoint, aws_credential, max_pool_connections)
+        owned_transfer_manager = TransferManager(
+            s3client,
+            build_transfer_config(max_concurrency, multipart_threshold=multipart_threshold, io_chunksize=io_chunksize),
+        )
+        transfer_manager = owned_transfer_manager
     target = Path(file.local_file)
-    target.parent.mkdir(exist_ok=True, parents=True)
+    if make_parent_dirs:
+        target.parent.mkdir(exist_ok=True, parents=True)
     exceptions = []
 
     for attempt in range(max_attempts):
         try:
-            if not use_cli:
-                s3client.download_file(bucket_name, file.s3file, str(target), Config=config)
+            if small_file:
+                download_small_file(s3client, bucket_name, file.s3file, target, io_chunksize)
+            elif not use_cli:
+                transfer_manager.download(bucket_name, file.s3file, str(target)).result()
+            elif is_downloaded(target, file):
+                print(f"Skipping {file}, it was already downloaded")
             else:
                 cmd = (
                     f"aws s3 --endpoint-url {aws_endpoint} --profile {aws_credential} "
@@ -318,15 +596,20 @@ def download_file(
                 f"[WARNING] Failed to download file {file} on attempt {attempt+1}/{max_attempts} with error: {type(error).__name__} {error}."
             )
             exceptions.append(error)
+            if is_fatal_download_error(error):
+                print(f"Not retrying download of file {file}, the error would affect every attempt.")
+                break
             if attempt + 1 < max_attempts:
                 print(f"Retrying download of file {file} - attempt {attempt+2}/{max_attempts}...")
                 time.sleep(1)
             else:
                 print(f"All {max_attempts} attempts exhausted - failed to download file {file}.")
+    if owned_transfer_manager is not None:
+        owned_transfer_manager.shutdown()
     elapsed = time.time() - start
     size_gb = file.size / (1024**3)
     if not exceptions:
-        print(f"Finished {progress}: {size_gb:.2f}GB in {elapsed:.0f}s ({size_gb/elapsed:.3f} GB/s) for file {target}")
+        print(f"Finished{progress}: {size_gb:.2f}GB in {elapsed:.0f}s ({size_gb/elapsed:.3f} GB/s) for file {target}")
     return DownloadOutput(elapsed, size_gb, exceptions)
 
 
@@ -340,56 +623,126 @@ def parallel_download_dataset_from_s3(
     use_cli=False,
     endpoint_fallback=False,
     max_attempts=2,
+    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+    multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+    io_chunksize=DEFAULT_IO_CHUNKSIZE,
 ) -> Tuple[List[GradientDatasetFile], Dict[str, List[str]]]:
     aws_credential = "gcdata-r"
     aws_endpoints = get_valid_aws_endpoints(endpoint_fallback)
+    # Every download thread may run `max_concurrency` transfers through the shared client
+    max_pool_connections = num_concurrent_downloads * max_concurrency
 
-    s3 = boto3.Session(profile_name=aws_credential).client("s3", endpoint_url=aws_endpoints[0])
-
-    # Disable thread use/transfer concurrency
+    s3 = get_s3_client(aws_endpoints[0], aws_credential, max_pool_connections)
 
     files_to_download: List[GradientDatasetFile] = []
-
-    failed_datasets = []
-    for dataset in datasets:
-        try:
-            files_to_download.extend(list_files(s3, dataset))
-        except MissingDataset as error:
-            logging.error(f"{dataset} is missing - skipping download. Error: {error}")
-            failed_datasets.append(dataset)
-
-    num_files = len(files_to_download)
-    print(f"Downloading {num_files} files from {len(datasets)} datasets")
-    logging.debug(f"Files to download: {files_to_download}")
     if symlink:
         logging.debug(f"Symlink mapping: {directory_map}")
-        files_to_download = apply_symlink(files_to_download, directory_map)
-        logging.debug(f"Files to download after symlinking: {files_to_download}")
+        source_target = symlink_source_target(directory_map)
 
-    start = time.time()
-    with ProcessPoolExecutor(max_workers=num_concurrent_downloads) as executor:
-        outputs = [
-            executor.submit(
-                download_file_iterate_endpoints,
-                aws_endpoints,
-                aws_credential,
-                file,
-                max_concurrency=max_concurrency,
-                use_cli=use_cli,
-                progress=f"{i+1}/{num_files}",
-                max_attempts=max_attempts,
-            )
-            for i, file in enumerate(files_to_download)
-        ]
+    # Files are queued as soon as their dataset is listed so downloads can start while
+    # other datasets are still being listed. Each listing queues `None` once it is done.
+    files_queue: "queue.Queue[Optional[GradientDatasetFile]]" = queue.Queue()
 
+    def queue_dataset_files(dataset: str):
+        try:
+            for file in list_files(s3, dataset):
+                files_queue.put(file)
+        finally:
+            files_queue.put(None)
+
+    # One transfer manager per endpoint is shared by all the downloads, so its worker threads
+    # are reused between files. It handles the parts of every file being downloaded at once.
+    transfer_config = build_transfer_config(
+        max_pool_connections,
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        io_chunksize=io_chunksize,
+    )
+    start = time.time()
     failed_downloads = []
-    for file, future_result in zip(files_to_download, outputs):
-        result = future_result.result()
-        if result.errors:
-            failed_downloads.append(f"{file} failed to download in {max_attempts} attempts with errors {result.errors}")
-            logging.error(failed_downloads[-1])
-    total_elapsed = time.time() - start
-    total_download_size = sum(o.result().gigabytes for o in outputs)
+    total_download_size = 0
+    # Downloads are network bound and botocore releases the GIL while waiting on sockets,
+    # so threads avoid paying for a new interpreter for every worker
+    with ThreadPoolExecutor(max_workers=num_concurrent_downloads) as listing_executor, contextlib.ExitStack() as stack:
+        listings = {dataset: listing_executor.submit(queue_dataset_files, dataset) for dataset in datasets}
+        # Contexts exit in reverse order: on an error the transfer managers cancel their in-flight
+        # transfers before the executor waits for the download threads to return
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=num_concurrent_downloads))
+        transfer_managers = {
+            aws_endpoint: stack.enter_context(
+                TransferManager(get_s3_client(aws_endpoint, aws_credential, max_pool_connections), transfer_config)
+            )
+            for aws_endpoint in aws_endpoints
+        }
+        outputs = {}
+        # Many files share a folder, each folder is created once here rather than by every download
+        created_dirs = set()
+        # Listing and download errors both cancel the downloads which have not finished yet
+        failed_datasets = []
+        try:
+            listings_in_progress = len(listings)
+            while listings_in_progress:
+                file = files_queue.get()
+                if file is None:
+                    listings_in_progress -= 1
+                    continue
+                if symlink:
+                    file = symlink_file(file, source_target)
+                files_to_download.append(file)
+                parent_dir = os.path.dirname(file.local_file)
+                if parent_dir not in created_dirs:
+                    os.makedirs(parent_dir, exist_ok=True)
+                    created_dirs.add(parent_dir)
+                future = executor.submit(
+                    download_file_iterate_endpoints,
+                    aws_endpoints,
+                    aws_credential,
+                    file,
+                    max_concurrency=max_concurrency,
+                    use_cli=use_cli,
+                    max_attempts=max_attempts,
+                    max_pool_connections=max_pool_connections,
+                    transfer_managers=transfer_managers,
+                    make_parent_dirs=False,
+                    multipart_threshold=multipart_threshold,
+                    io_chunksize=io_chunksize,
+                )
+                outputs[future] = file
+
+            num_files = len(files_to_download)
+            print(f"Downloading {num_files} files from {len(datasets)} datasets")
+            logging.debug(f"Files to download: {files_to_download}")
+
+            for dataset, listing in listings.items():
+                try:
+                    listing.result()
+                except MissingDataset as error:
+                    logging.error(f"{dataset} is missing - skipping download. Error: {error}")
+                    failed_datasets.append(dataset)
+
+            # Results are aggregated as downloads finish so a fatal error cancels the pending ones.
+            # The number of files is only known once the listings are done, so progress is reported here.
+            completed = 0
+            for future in as_completed(outputs):
+                result = future.result()
+                completed += 1
+                total_download_size += result.gigabytes
+                if result.errors:
+                    failed_downloads.append(
+                        f"{outputs[future]} failed to download in {max_attempts} attempts with errors {result.errors}"
+                    )
+                    logging.error(failed_downloads[-1])
+                    if any(is_fatal_download_error(error) for error in result.errors):
+                        raise S3DownloadFailed(
+                            f"Aborting the {num_files - completed} remaining downloads after a fatal error"
+                            f" downloading {outputs[future]}"
+                        ) from result.errors[-1]
+                print(f"Completed {completed}/{num_files} downloads ({total_download_size:.2f} GB)")
+        except Exception:
+            for future in outputs:
+                future.cancel()
+            raise
+        total_elapsed = time.time() - start
     if not failed_downloads:
         print(
             f"Finished downloading {num_files} files: {total_download_size:.2f} GB in {total_elapsed:.2f}s ({total_download_size/total_elapsed:.2f}  GB/s)"
@@ -415,7 +768,8 @@ def read_gradient_settings(gradient_settings_file: Path) -> List[str]:
             ...
     """
     with open(gradient_settings_file) as f:
-        my_dict = yaml.safe_load(f)
+        # Use the libyaml parser when PyYAML was built with it
+        my_dict = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
         datasets = my_dict["integrations"].keys()
     return list(datasets)
 
@@ -428,15 +782,20 @@ def copy_graphcore_s3(args):
     json_data = os.path.expandvars(json_data)
     symlink_config = json.loads(json_data)
     datasets = read_gradient_settings(args.gradient_settings_file)
-    prepare_cred()
+    # Each file is copied by its own CLI process, which makes up to `max_concurrency` requests
+    prepare_cred(args.max_concurrency if args.use_cli else None)
     _, errors = parallel_download_dataset_from_s3(
         datasets,
         symlink_config,
         max_concurrency=args.max_concurrency,
         num_concurrent_downloads=args.num_concurrent_downloads,
         symlink=not args.no_symlink,
+        use_cli=args.use_cli,
         endpoint_fallback=args.public_endpoint,
         max_attempts=args.max_attempts,
+        multipart_threshold=args.multipart_threshold,
+        multipart_chunksize=args.multipart_chunksize,
+        io_chunksize=args.io_chunksize,
     )
     if errors:
         raise RuntimeError(
@@ -454,6 +813,21 @@ def symlink_arguments(parser=argparse.ArgumentParser()) -> argparse.ArgumentPars
         "--num-concurrent-downloads", default=1, type=int, help="Number of concurrent files to download"
     )
     parser.add_argument("--max-concurrency", default=1, type=int, help="S3 maximum concurrency")
+    parser.add_argument(
+        "--multipart-threshold",
+        default=DEFAULT_MULTIPART_THRESHOLD,
+        type=int,
+        help="Size in bytes above which files are downloaded in multiple parts",
+    )
+    parser.add_argument(
+        "--multipart-chunksize", default=DEFAULT_MULTIPART_CHUNKSIZE, type=int, help="Size in bytes of each part"
+    )
+    parser.add_argument(
+        "--io-chunksize",
+        default=DEFAULT_IO_CHUNKSIZE,
+        type=int,
+        help="Size in bytes of the chunks read from the network and written to disk",
+    )
     parser.add_argument("--config-file", default=str(Path(".").resolve().parent / "symlink_config.json"))
     parser.add_argument(
         "--gradient-settings-file",
@@ -49,6 +49,7 @@ def get_version():
 extra_requires = {
     "dev": read_requirements("requirements-dev.txt"),
     "logger": read_requirements("requirements-logger.txt"),
+    "inotify": read_requirements("requirements-inotify.txt"),
 }
 extra_requires["all"] = []
 for reqs in extra_requires.values():
@@ -81,8 +82,11 @@ setup(
     package_data={
         "graphcore_cloud_tools":
         # Paths need to be relative to `graphcore-cloud-tools/` folder
-        [os.path.join(*Path(f).parts[1:]) for f in glob("graphcore_cloud_tools/**/*.py", recursive=True)]
-        + [os.path.join(*Path(f).parts[1:]) for f in glob("graphcore_cloud_tools/**/*.cpp", recursive=True)]
+        [
+            os.path.join(*Path(f).parts[1:])
+            for f in glob("graphcore_cloud_tools/**/*", recursive=True)
+            if Path(f).suffix in {".py", ".cpp"}
+        ]
     },
     version=get_version(),
 )
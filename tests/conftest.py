@@ -0,0 +1,157 @@
+# Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+"""Fixtures shared by the symlink and command line tests"""
+from typing import Dict, List
+import pathlib
+import pytest
+import json
+from graphcore_cloud_tools.paperspace_utils import symlink_datasets_and_caches
+from moto.server import ThreadedMotoServer
+import boto3
+import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import http.server
+import shutil
+import socket
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+
+
+@pytest.fixture
+def fake_data(tmp_path: pathlib.Path, monkeypatch):
+    monkeypatch.setenv(symlink_datasets_and_caches.LEGACY_DATASET_ENV_VAR, str(tmp_path))
+    source = tmp_path / "source"
+    source2 = tmp_path / "source2"
+    for directory in (source, source2):
+        directory.mkdir(parents=True)
+    (source / "test1.txt").write_bytes(b"test file 1")
+    (source2 / "test2.txt").write_bytes(b"test file 2")
+    return [source, source2]
+
+
+@pytest.fixture
+def settings_file(tmp_path: pathlib.Path, fake_data: List[pathlib.Path]):
+    config = tmp_path / "settings.yaml"
+    settings = dict(integrations={data.name: dict(type="dataset", ref="fake:data") for data in fake_data})
+    config.write_text(yaml.dump(settings))
+    return config
+
+
+@pytest.fixture
+def symlink_def(tmp_path: pathlib.Path, fake_data: List[pathlib.Path]) -> Dict[str, List[str]]:
+    """The symlink config as a dictionary, mapping the target folder to its source folders"""
+    return {str(tmp_path / "target"): [str(f) for f in fake_data]}
+
+
+def unmount_overlays(root: pathlib.Path):
+    """Unmounts the overlays mounted below `root`, nested mount points first"""
+    with open("/proc/mounts") as f:
+        mount_points = [line.split()[1] for line in f]
+    for mount_point in sorted((m for m in mount_points if m.startswith(f"{root}/")), reverse=True):
+        if subprocess.run(["umount", mount_point], capture_output=True).returncode != 0 and shutil.which("fusermount"):
+            subprocess.run(["fusermount", "-u", mount_point], capture_output=True)
+
+
+@pytest.fixture
+def symlink_config(tmp_path: pathlib.Path, symlink_def: Dict[str, List[str]], monkeypatch):
+    """The symlink config file, overlays created by the test are unmounted when it ends"""
+    config = tmp_path / "symlink_config.json"
+    config.write_text(json.dumps(symlink_def))
+    fuse_root = config.parent / "fusedoverlay"
+    fuse_root.mkdir()
+    monkeypatch.setenv("SYMLINK_FUSE_ROOTDIR", str(fuse_root))
+    yield config
+    unmount_overlays(tmp_path)
+
+
+@pytest.fixture(scope="session")
+def s3_server():
+    """Uses moto to start a mocked S3 endpoint on a local port, shared by the whole session"""
+    # Let the OS pick a free port instead of probing ports one by one
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    # Start the S3 service
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+    # Check that the server is working
+    try:
+        urllib.request.urlopen(endpoint_url, timeout=5).close()
+    except urllib.error.HTTPError:
+        # Any HTTP response means the server is up
+        pass
+    except (urllib.error.URLError, OSError) as error:
+        server.stop()
+        raise ValueError(f"Failed to mock S3 server on port {port}") from error
+    print(f"Started Mock S3 server at {endpoint_url}")
+    yield endpoint_url
+    server.stop()
+
+
+@pytest.fixture
+def http_server():
+    """Starts local HTTP servers answering requests with a handler class, returns their URL"""
+    servers = []
+
+    def start(handler: "type[http.server.BaseHTTPRequestHandler]") -> str:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def s3_endpoint_url(s3_server: str, monkeypatch):
+    """Empties the mocked S3 endpoint so that each test starts without any bucket"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SECURITY_TOKEN", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    urllib.request.urlopen(urllib.request.Request(f"{s3_server}/moto-api/reset", method="POST"), timeout=5).close()
+    return s3_server
+
+
+@pytest.fixture
+def s3_datasets(symlink_config: pathlib.Path, symlink_def: Dict[str, List[str]], s3_endpoint_url: str):
+    """Uploads the mocked datasets to a mock S3"""
+    bucket = "sdk"
+    conn = boto3.resource("s3", endpoint_url=s3_endpoint_url)
+    try:
+        conn.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": s3_endpoint_url},
+        )
+    except Exception as error:
+        if "BucketAlreadyOwnedByYou" in str(error):
+            pass
+        else:
+            raise
+
+    new_symlink_def = {}
+    # Upload files concurrently through boto3 rather than starting the AWS CLI for every source
+    client = conn.meta.client
+    uploads = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for key, sources in symlink_def.items():
+            new_symlink_def[key] = []
+            for source in sources:
+                source = pathlib.Path(source)
+                prefix = f"{symlink_datasets_and_caches.S3_DATASET_FOLDER}/{source.name}"
+                for file in source.rglob("*"):
+                    if file.is_file():
+                        s3_key = f"{prefix}/{file.relative_to(source).as_posix()}"
+                        uploads.append(executor.submit(client.upload_file, str(file), bucket, s3_key))
+                new_symlink_def[key].append(f"/{prefix}")
+        for upload in as_completed(uploads):
+            upload.result()
+
+    new_config = symlink_config.parent / f"{symlink_config.name}-s3.json"
+    new_config.write_text(json.dumps(new_symlink_def))
+    return (new_config, s3_endpoint_url)
@@ -2,12 +2,8 @@
 from graphcore_cloud_tools import notebook_logging
 
 
-import pathlib
 from . import testutils
-
-
-REPO_ROOT = pathlib.Path(__file__).parents[1].resolve()
-TEST_FILES_DIR = REPO_ROOT / "tests" / "test_files"
+from .testutils import REPO_ROOT, TEST_FILES_DIR
 
 
 def test_notebook():
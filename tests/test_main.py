@@ -1,25 +1,15 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
+import argparse
+import os
 import sys
-import pathlib
 import pytest
-from . import test_symlink
 from . import testutils
-from graphcore_cloud_tools.paperspace_utils import symlink_datasets_and_caches
-
-
-REPO_ROOT = pathlib.Path(__file__).parents[1].resolve()
-TEST_FILES_DIR = REPO_ROOT / "tests" / "test_files"
-
-
-fake_data = test_symlink.fake_data
-symlink_config = test_symlink.symlink_config
-settings_file = test_symlink.settings_file
-s3_datasets = test_symlink.s3_datasets
-s3_endpoint_url = test_symlink.s3_endpoint_url
+from graphcore_cloud_tools import __main__ as cli
+from graphcore_cloud_tools.paperspace_utils import health_check, symlink_datasets_and_caches
 
 
 def test_symlink_command(symlink_config):
-    """Test the support for fuse-overlay symlinks"""
+    """Test the support for fuse-overlay symlinks through the package's entry point"""
     testutils.run_command_fail_explicitly(
         [
             sys.executable,
@@ -30,7 +20,7 @@ def test_symlink_command(symlink_config):
             "--config-file",
             f"{symlink_config}",
         ],
-        cwd=str(REPO_ROOT),
+        cwd=str(testutils.REPO_ROOT),
     )
 
 
@@ -39,12 +29,17 @@ def test_s3_symlink_command(settings_file, s3_datasets, monkeypatch, legacy):
     """Test the direct S3 overlay method"""
     config_file, endpoint_url = s3_datasets
     monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, endpoint_url)
+    # The legacy override rewrites this variable, set it through monkeypatch so it is restored
+    monkeypatch.setenv(
+        symlink_datasets_and_caches.S3_DATASETS_DIR_ENV_VAR,
+        os.getenv(
+            symlink_datasets_and_caches.S3_DATASETS_DIR_ENV_VAR, symlink_datasets_and_caches.DEFAULT_S3_DATASET_DIR
+        ),
+    )
     if legacy:
         monkeypatch.setenv(symlink_datasets_and_caches.DATASET_METHOD_OVERRIDE_ENV_VAR, "OVERLAY")
-    testutils.run_command_fail_explicitly(
+    cli.main(
         [
-            sys.executable,
-            "-m",
             "graphcore_cloud_tools",
             "paperspace",
             "symlinks",
@@ -53,12 +48,26 @@ def test_s3_symlink_command(settings_file, s3_datasets, monkeypatch, legacy):
             "--gradient-settings-file",
             str(settings_file),
             "--s3-dataset",
-        ],
-        cwd=str(REPO_ROOT),
+        ]
     )
 
 
 def test_healthcheck_command(tmp_path, settings_file, symlink_config):
+    args = health_check.parse_args(
+        argparse.ArgumentParser(),
+        [
+            "--log-folder",
+            f"{tmp_path}",
+            "--gradient-settings-file",
+            str(settings_file),
+            "--symlink-config-file",
+            str(symlink_config),
+        ],
+    )
+    health_check.run_health_check(args)
+
+
+def test_healthcheck_script(tmp_path, settings_file, symlink_config):
     testutils.run_command_fail_explicitly(
         [
             sys.executable,
@@ -71,5 +80,5 @@ def test_healthcheck_command(tmp_path, settings_file, symlink_config):
             "--symlink-config-file",
             str(symlink_config),
         ],
-        cwd=str(REPO_ROOT),
+        cwd=str(testutils.REPO_ROOT),
     )
@@ -5,7 +5,10 @@ from graphcore_cloud_tools.paperspace_utils import (
     get_metadata_file_data,
     check_files_match_metadata,
 )
+from graphcore_cloud_tools.paperspace_utils import metadata_utils
 import pytest
+import hashlib
+import os
 import json
 from pathlib import Path
 import logging
@@ -58,3 +61,13 @@ def test_file_size_inaccurate_in_metadata(generate_data, caplog):
             "local value": "22",
         }
     assert str(change_dict) in caplog.text
+
+
+@pytest.mark.parametrize("file_digest", [True, False])
+def test_md5_hash_file(tmp_path, monkeypatch, file_digest):
+    if not file_digest:
+        monkeypatch.delattr(hashlib, "file_digest", raising=False)
+    monkeypatch.setattr(metadata_utils, "HASH_CHUNK_SIZE", 1024)
+    content = os.urandom(10 * 1024 + 17)
+    (tmp_path / "data.bin").write_bytes(content)
+    assert metadata_utils.md5_hash_file(tmp_path / "data.bin") == hashlib.md5(content).hexdigest()
@@ -1,49 +1,76 @@
 # Copyright (c) 2023 Graphcore Ltd. All rights reserved.
-from typing import Dict, List, Callable
+from typing import Dict, List, Callable, Optional
 import pathlib
 import pytest
 import json
 import argparse
 from graphcore_cloud_tools.paperspace_utils import symlink_datasets_and_caches
-from moto.server import ThreadedMotoServer
 import boto3
-import subprocess
-import yaml
+import http.server
+import socket
 import logging
 import os
+import shutil
+import subprocess
 import warnings
+import threading
+import time
+import botocore.exceptions
+
+
+class ForbiddenHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every request with a 403, like an S3 endpoint rejecting the credentials"""
+
+    def forbidden(self):
+        self.send_response(403)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
+    do_HEAD = do_GET = forbidden
 
-@pytest.fixture
-def fake_data(tmp_path: pathlib.Path, monkeypatch):
-    monkeypatch.setenv(symlink_datasets_and_caches.LEGACY_DATASET_ENV_VAR, str(tmp_path))
-    source = tmp_path / "source"
-    source2 = tmp_path / "source2"
-    source.mkdir(parents=True)
-    source2.mkdir(parents=True)
-    (source / "test1.txt").write_text("test file 1")
-    (source2 / "test2.txt").write_text("test file 2")
-    return [source, source2]
+    def log_message(self, *args):
+        pass
+
+
+class BadStatusLineHandler(http.server.BaseHTTPRequestHandler):
+    """Answers requests with a status line which is not HTTP"""
+
+    def handle(self):
+        while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        self.wfile.write(b"NOT-HTTP\r\n\r\n")
 
 
-@pytest.fixture
-def settings_file(tmp_path: pathlib.Path, fake_data: List[pathlib.Path]):
-    config = tmp_path / "settings.yaml"
-    settings = dict(integrations={data.name: dict(type="dataset", ref="fake:data") for data in fake_data})
-    with open(config, "w") as f:
-        yaml.dump(settings, f)
-    return config
+def unused_port_url() -> str:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def expected_symlinked_paths(symlink_def: Dict[str, List[str]]) -> List[str]:
+    """Paths at which the files of every source folder should appear in its target folder"""
+    expected_paths = []
+    for target_path, source_paths in symlink_def.items():
+        target_path = pathlib.Path(target_path).resolve()
+        for source_path in source_paths:
+            source_path = pathlib.Path(source_path).resolve()
+            source_len = len(str(source_path))
+            expected_paths.extend(
+                f"{target_path}{path[source_len:]}" for path in symlink_datasets_and_caches.walk_paths(source_path)
+            )
+    return expected_paths
 
 
-@pytest.fixture
-def symlink_config(tmp_path: pathlib.Path, fake_data: List[pathlib.Path], monkeypatch):
-    config = tmp_path / "symlink_config.json"
-    target = tmp_path / "target"
-    config.write_text(json.dumps({str(target): [str(f) for f in fake_data]}))
-    fuse_root = config.parent / "fusedoverlay"
-    fuse_root.mkdir()
-    monkeypatch.setenv("SYMLINK_FUSE_ROOTDIR", str(fuse_root))
-    return config
+def mount_fstype(path: pathlib.Path) -> Optional[str]:
+    """The filesystem type of the last mount on `path`, None if nothing is mounted on it"""
+    fstype = None
+    with open("/proc/mounts") as f:
+        for line in f:
+            _, mount_point, mounted_fstype, *_ = line.split()
+            if mount_point == str(path):
+                fstype = mounted_fstype
+    return fstype
 
 
 def check_files_are_visible_in_symlink_folder(function_under_test: Callable, symlink_config: pathlib.Path):
@@ -57,138 +84,83 @@ def check_files_are_visible_in_symlink_folder(function_under_test: Callable, sym
     # root_path is used to make errors more readable with shorter paths
     root_path = symlink_config.parent
     symlink_def: Dict[str, List[str]] = json.loads(symlink_config.read_text())
-    expected_before_symlink_paths = []
-    for target_path, source_paths in symlink_def.items():
-        target_path = pathlib.Path(target_path).resolve()
-        for source_path in source_paths:
-            source_path = pathlib.Path(source_path).resolve()
-            expected_before_symlink_paths.extend(
-                [str((target_path / f.relative_to(source_path)).resolve()) for f in source_path.rglob("*")]
-            )
+    expected_before_symlink_paths = expected_symlinked_paths(symlink_def)
 
     # Create the symlinks
     out = function_under_test()
 
-    # Get the list of files in the source directories
-    expected_paths: List[pathlib.Path] = []
-    for target_path, source_paths in symlink_def.items():
-        target_path = pathlib.Path(target_path).resolve()
-        for source_path in source_paths:
-            source_path = pathlib.Path(source_path).resolve()
-            expected_paths.extend(
-                [str((target_path / f.relative_to(source_path)).resolve()) for f in source_path.rglob("*")]
-            )
+    # Get the list of files in the source directories, walked again to catch writes to the sources
+    expected_paths = expected_symlinked_paths(symlink_def)
 
     # Find all the files after symlink creation
     found = []
     for target_path, source_paths in symlink_def.items():
         target_path = pathlib.Path(target_path).resolve()
-        found.extend([str(f) for f in target_path.rglob("*")])
+        found.extend(symlink_datasets_and_caches.walk_paths(target_path))
 
+    expected_set = set(expected_paths)
+    found_set = set(found)
     # Check that the source files haven't changed
     files_added_by_symlinking = [
-        e.relative_to(root_path) for e in expected_paths if e not in expected_before_symlink_paths
+        pathlib.Path(e).relative_to(root_path) for e in sorted(expected_set - set(expected_before_symlink_paths))
     ]
     assert (
         not files_added_by_symlinking
     ), f"Symlinking created files or folders in read/only space {files_added_by_symlinking}"
     # Check that the symlink files are there
-    missing_files = [e.relative_to(root_path) for e in expected_paths if e not in found]
+    missing_files = [pathlib.Path(e).relative_to(root_path) for e in sorted(expected_set - found_set)]
     assert not missing_files, f"There were missing files: {missing_files}\n found: {found}\n expected: {expected_paths}"
-    extra_files = [pathlib.Path(e).relative_to(root_path) for e in found if e not in expected_paths]
+    extra_files = [pathlib.Path(e).relative_to(root_path) for e in sorted(found_set - expected_set)]
     assert not extra_files, f"There were extra files: {extra_files}\n found: {found}\n expected: {expected_paths}"
     return out
 
 
-@pytest.fixture
-def s3_endpoint_url(monkeypatch):
-    """Uses moto to start a mocked S3 endpoint on a local port"""
-    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
-    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
-    monkeypatch.setenv("AWS_SECURITY_TOKEN", "testing")
-    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
-
-    port = 7000
-    endpoint_url = f"http://127.0.0.1:{port}"
-    started_server = False
-    # try ports from 7000 to 8000 for a valid one
-    # Finds an open port to start the server on
-    for i in range(1000):
-        # First: check that the port is closed (curl should fail or we skip to the next port)
-        try:
-            subprocess.check_output(["curl", endpoint_url], timeout=5)
-            continue
-        except:
-            pass
-        # Start the S3 service
-        server = ThreadedMotoServer(port=port + i)
-        server.start()
-        endpoint_url = f"http://127.0.0.1:{port + i}"
-        # CHeck that the server is working
-        try:
-            subprocess.check_output(["curl", endpoint_url], timeout=5)
-            started_server = True
-            break
-        except:
-            server.stop()
-            continue
-    if not started_server:
-        raise ValueError(f"Failed to mock S3 server on ports {port} to {port + i}")
-    else:
-        print(f"Started Mock S3 server at {endpoint_url}")
-    yield endpoint_url
-    server.stop()
-
-
-@pytest.fixture
-def s3_datasets(symlink_config: pathlib.Path, s3_endpoint_url: str):
-    """Uploads the mocked datasets to a mock S3"""
-    bucket = "sdk"
-    conn = boto3.resource("s3", endpoint_url=s3_endpoint_url)
-    try:
-        conn.create_bucket(
-            Bucket=bucket,
-            CreateBucketConfiguration={"LocationConstraint": s3_endpoint_url},
-        )
-    except Exception as error:
-        if "BucketAlreadyOwnedByYou" in str(error):
-            pass
-        else:
-            raise
-
-    symlink_def: Dict[str, List[str]] = json.loads(symlink_config.read_text())
-    new_symlink_def = {}
-    # Upload files
-    for key, sources in symlink_def.items():
-        new_symlink_def[key] = []
-        for source in sources:
-            source = pathlib.Path(source)
-            out = subprocess.check_output(
-                [
-                    "aws",
-                    "s3",
-                    "sync",
-                    "--endpoint-url",
-                    s3_endpoint_url,
-                    source,
-                    f"s3://{bucket}/{symlink_datasets_and_caches.S3_DATASET_FOLDER}/{source.name}/",
-                ]
-            )
-            print(out)
-            new_symlink_def[key].append(f"/{symlink_datasets_and_caches.S3_DATASET_FOLDER}/{source.name}")
+@pytest.mark.parametrize("kernel_overlay", [True, False])
+def test_fuse_overlay_symlinking(symlink_config, symlink_def, monkeypatch, kernel_overlay):
+    if kernel_overlay and os.geteuid() != 0:
+        pytest.skip("The kernel overlay is only mounted when running as root")
+    if not kernel_overlay and shutil.which("fuse-overlayfs") is None:
+        pytest.skip("fuse-overlayfs is not installed")
+    monkeypatch.setenv(symlink_datasets_and_caches.KERNEL_OVERLAY_ENV_VAR, "1" if kernel_overlay else "0")
 
-    new_config = symlink_config.parent / f"{symlink_config.name}-s3.json"
-    new_config.write_text(json.dumps(new_symlink_def))
-    return (new_config, s3_endpoint_url)
-
-
-def test_fuse_overlay_symlinking(symlink_config):
     def function():
         return symlink_datasets_and_caches.symlink_gradient_datasets(
             argparse.Namespace(config_file=str(symlink_config))
         )
 
     check_files_are_visible_in_symlink_folder(function, symlink_config)
+    # The files are visible with either mount, check that the requested one was used
+    for target_dir in symlink_def:
+        assert mount_fstype(pathlib.Path(target_dir).resolve()) == (
+            "overlay" if kernel_overlay else "fuse.fuse-overlayfs"
+        )
+
+
+@pytest.mark.parametrize("fuse_returncode", [0, 1])
+def test_kernel_overlay_falls_back_to_fuse_overlayfs(symlink_config, symlink_def, monkeypatch, fuse_returncode):
+    commands = []
+
+    def run(command, **kwargs):
+        commands.append(command)
+        return subprocess.CompletedProcess(command, fuse_returncode, stdout="")
+
+    monkeypatch.setattr(symlink_datasets_and_caches.os, "geteuid", lambda: 0)
+    monkeypatch.setattr(
+        symlink_datasets_and_caches,
+        "mount_kernel_overlay",
+        lambda options, target_dir: subprocess.CompletedProcess(["mount"], 1, stdout="mount: Operation not permitted"),
+    )
+    monkeypatch.setattr(symlink_datasets_and_caches.subprocess, "run", run)
+    (target_dir,) = symlink_def
+    out = symlink_datasets_and_caches.create_overlays(symlink_def[target_dir], target_dir)
+    assert out.returncode == fuse_returncode
+    ((program, *_, options, target),) = commands
+    assert program == "fuse-overlayfs"
+    assert options.startswith(f"lowerdir={':'.join(symlink_def[target_dir])},")
+    assert target == target_dir
+    if fuse_returncode:
+        with pytest.raises(RuntimeError, match="failed with error"):
+            symlink_datasets_and_caches.symlink_gradient_datasets(argparse.Namespace(config_file=str(symlink_config)))
 
 
 def test_s3_linking(monkeypatch, s3_datasets, settings_file, symlink_config, caplog):
@@ -239,3 +211,326 @@ def test_s3_retry_download(monkeypatch, s3_datasets):
         max_attempts=max_attempts,
     )
     assert len(out.errors) == max_attempts
+
+
+def test_get_valid_aws_endpoints(monkeypatch, s3_endpoint_url, http_server):
+    """Endpoints which answer with any HTTP status are kept in order, the others are dropped"""
+    forbidden = http_server(ForbiddenHandler)
+    endpoints = [unused_port_url(), s3_endpoint_url, http_server(BadStatusLineHandler), forbidden]
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, ";".join(endpoints))
+    assert symlink_datasets_and_caches.get_valid_aws_endpoints() == [s3_endpoint_url, forbidden]
+
+
+@pytest.mark.parametrize("parent", ["", "data"])
+def test_gradient_dataset_file_from_response(monkeypatch, tmp_path, parent):
+    """Prefix components which are substrings of, or appear in, the local root must still be appended"""
+    tmp_path = tmp_path / parent
+    monkeypatch.setenv(symlink_datasets_and_caches.S3_DATASETS_DIR_ENV_VAR, f"{tmp_path}/graphcore-gradient-datasets")
+    prefix = f"{symlink_datasets_and_caches.S3_DATASET_FOLDER}/data/"
+    response = {
+        "Name": "sdk",
+        "Prefix": prefix,
+        "Contents": [{"Key": f"{prefix}test1.txt", "Size": 11}, {"Key": f"{prefix}sub/test2.txt"}],
+    }
+    files = list(symlink_datasets_and_caches.GradientDatasetFile.from_response(response))
+    local_root = (tmp_path / "graphcore-gradient-datasets" / "data").resolve()
+    assert [f.local_file for f in files] == [str(local_root / "test1.txt"), str(local_root / "sub" / "test2.txt")]
+    assert [f.size for f in files] == [11, 0]
+
+
+def test_s3_multipart_download(monkeypatch, s3_datasets, settings_file):
+    """Files above the multipart threshold are downloaded as concurrent byte ranges"""
+    config_file, endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, endpoint_url)
+    symlink_datasets_and_caches.prepare_cred()
+    config = json.loads(config_file.read_text())
+    datasets = symlink_datasets_and_caches.read_gradient_settings(settings_file)
+    content = os.urandom(10 * 1024 + 17)
+    boto3.client("s3", endpoint_url=endpoint_url).put_object(
+        Bucket="sdk", Key=f"{symlink_datasets_and_caches.S3_DATASET_FOLDER}/{datasets[0]}/large.bin", Body=content
+    )
+
+    transferred_keys = []
+    original_download = symlink_datasets_and_caches.TransferManager.download
+
+    def download(self, bucket, key, *args, **kwargs):
+        transferred_keys.append(key)
+        return original_download(self, bucket, key, *args, **kwargs)
+
+    monkeypatch.setattr(symlink_datasets_and_caches.TransferManager, "download", download)
+    files, errors = symlink_datasets_and_caches.parallel_download_dataset_from_s3(
+        datasets,
+        config,
+        max_concurrency=4,
+        num_concurrent_downloads=2,
+        multipart_threshold=1024,
+        multipart_chunksize=1024,
+    )
+    assert not errors
+    (large_file,) = [f for f in files if f.s3file.endswith("large.bin")]
+    assert pathlib.Path(large_file.local_file).read_bytes() == content
+    # Only the file above the multipart threshold goes through the shared transfer manager
+    assert transferred_keys == [large_file.s3file]
+
+
+def test_check_dataset_is_mounted_waits_for_dataset(tmp_path):
+    dataset = tmp_path / "late_dataset"
+
+    def mount():
+        dataset.mkdir()
+        (dataset / "test.txt").write_text("test file")
+
+    timer = threading.Timer(1.5, mount)
+    timer.start()
+    try:
+        found = symlink_datasets_and_caches.check_dataset_is_mounted([str(dataset)])
+    finally:
+        timer.join()
+    assert found == [str(dataset)]
+
+
+def test_wait_for_directory_change_wakes_up_on_creation(tmp_path):
+    inotify_simple = pytest.importorskip("inotify_simple")
+    dataset = tmp_path / "late_dataset"
+    timer = threading.Timer(0.2, dataset.mkdir)
+    inotify = inotify_simple.INotify()
+    timer.start()
+    try:
+        start = time.monotonic()
+        symlink_datasets_and_caches.wait_for_directory_change(inotify, dataset, timeout=30)
+        elapsed = time.monotonic() - start
+    finally:
+        timer.join()
+        inotify.close()
+    assert dataset.exists()
+    assert elapsed < 10
+
+
+def test_check_dataset_is_mounted_without_inotify(tmp_path, monkeypatch):
+    """Datasets are still found by polling when inotify instances or watches cannot be created"""
+
+    class ExhaustedINotify:
+        def __init__(self):
+            raise OSError(24, "Too many open files")
+
+    class NoWatchINotify:
+        def add_watch(self, path, mask):
+            raise OSError(28, "No space left on device")
+
+        def close(self):
+            pass
+
+    dataset = tmp_path / "late_dataset"
+
+    def mount():
+        dataset.mkdir()
+        (dataset / "test.txt").write_text("test file")
+
+    for inotify_class in (ExhaustedINotify, NoWatchINotify):
+        monkeypatch.setattr(symlink_datasets_and_caches, "INotify", inotify_class)
+        monkeypatch.setattr(
+            symlink_datasets_and_caches, "inotify_flags", argparse.Namespace(CREATE=1, MOVED_TO=2), raising=False
+        )
+        timer = threading.Timer(0.2, mount)
+        timer.start()
+        try:
+            found = symlink_datasets_and_caches.check_dataset_is_mounted([str(dataset)])
+        finally:
+            timer.join()
+        assert found == [str(dataset)]
+        shutil.rmtree(dataset)
+
+
+def test_check_dataset_is_mounted_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(symlink_datasets_and_caches, "DATASET_MOUNT_TIMEOUT_SECONDS", 1)
+    with pytest.warns(UserWarning, match="Abandoning symlink"):
+        found = symlink_datasets_and_caches.check_dataset_is_mounted([str(tmp_path / "missing_dataset")])
+    assert found == []
+
+
+def test_s3_fatal_error_cancels_downloads(monkeypatch, s3_datasets, settings_file):
+    config_file, endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, endpoint_url)
+    symlink_datasets_and_caches.prepare_cred()
+    config = json.loads(config_file.read_text())
+    datasets = symlink_datasets_and_caches.read_gradient_settings(settings_file)
+    access_denied = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+    monkeypatch.setattr(
+        symlink_datasets_and_caches,
+        "download_file",
+        lambda *args, **kwargs: symlink_datasets_and_caches.DownloadOutput(0, 0, [access_denied]),
+    )
+    with pytest.raises(symlink_datasets_and_caches.S3DownloadFailed, match="fatal error"):
+        symlink_datasets_and_caches.parallel_download_dataset_from_s3(datasets, config)
+
+
+def test_s3_forbidden_transfer_aborts_downloads(monkeypatch, tmp_path, http_server):
+    """A 403 on the transfer manager's HeadObject carries no error code but still aborts the downloads"""
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, http_server(ForbiddenHandler))
+    symlink_datasets_and_caches.prepare_cred()
+    large_files = [
+        symlink_datasets_and_caches.GradientDatasetFile(
+            s3file=f"large{i}.bin",
+            local_file=str(tmp_path / f"large{i}.bin"),
+            size=symlink_datasets_and_caches.DEFAULT_MULTIPART_THRESHOLD,
+        )
+        for i in range(3)
+    ]
+    monkeypatch.setattr(symlink_datasets_and_caches, "list_files", lambda client, dataset_name: iter(large_files))
+    with pytest.raises(symlink_datasets_and_caches.S3DownloadFailed, match="fatal error") as excinfo:
+        symlink_datasets_and_caches.parallel_download_dataset_from_s3(["dataset"], {}, symlink=False, max_attempts=3)
+    error = excinfo.value.__cause__
+    assert isinstance(error, botocore.exceptions.ClientError)
+    assert error.response["ResponseMetadata"]["HTTPStatusCode"] == 403
+
+
+def test_s3_listing_error_cancels_downloads(monkeypatch, s3_datasets, settings_file):
+    config_file, endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, endpoint_url)
+    symlink_datasets_and_caches.prepare_cred()
+    config = json.loads(config_file.read_text())
+    datasets = symlink_datasets_and_caches.read_gradient_settings(settings_file)[:1]
+    access_denied = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "ListObjectsV2")
+
+    def list_files(client, dataset_name):
+        for i in range(5):
+            yield symlink_datasets_and_caches.GradientDatasetFile(
+                s3file=f"{dataset_name}/{i}.txt", local_file=str(config_file.parent / "listed" / f"{i}.txt")
+            )
+        raise access_denied
+
+    events = []
+
+    def download_file(aws_endpoint, aws_credential, file, **kwargs):
+        events.append(("download", file.s3file))
+        time.sleep(0.5)
+        events.append(("downloaded", file.s3file))
+        return symlink_datasets_and_caches.DownloadOutput(0, 0, [])
+
+    original_exit = symlink_datasets_and_caches.TransferManager.__exit__
+
+    def transfer_manager_exit(self, exc_type, *args):
+        events.append(("transfer_manager_exit", exc_type))
+        return original_exit(self, exc_type, *args)
+
+    monkeypatch.setattr(symlink_datasets_and_caches, "list_files", list_files)
+    monkeypatch.setattr(symlink_datasets_and_caches, "download_file", download_file)
+    monkeypatch.setattr(symlink_datasets_and_caches.TransferManager, "__exit__", transfer_manager_exit)
+    with pytest.raises(botocore.exceptions.ClientError, match="AccessDenied"):
+        symlink_datasets_and_caches.parallel_download_dataset_from_s3(datasets, config, symlink=False)
+    # Only the download started before the listing failed ran, the queued ones were cancelled
+    started = [key for event, key in events if event == "download"]
+    assert 1 <= len(started) < 5
+    # The transfer managers are cancelled while the in-flight download is still running
+    assert events.index(("transfer_manager_exit", botocore.exceptions.ClientError)) < events.index(
+        ("downloaded", started[0])
+    )
+
+
+def test_s3_small_file_download(monkeypatch, s3_datasets, tmp_path):
+    """Files below the small file threshold are fetched without a transfer manager"""
+    _, s3_endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, s3_endpoint_url)
+    symlink_datasets_and_caches.prepare_cred()
+    boto3.client("s3", endpoint_url=s3_endpoint_url).put_object(Bucket="sdk", Key="small.txt", Body=b"small file")
+    monkeypatch.setattr(symlink_datasets_and_caches, "TransferManager", None)
+    file = symlink_datasets_and_caches.GradientDatasetFile(
+        s3file="small.txt", local_file=str(tmp_path / "small.txt"), size=10
+    )
+    out = symlink_datasets_and_caches.download_file(
+        s3_endpoint_url, aws_credential="gcdata-r", file=file, max_concurrency=1, use_cli=False
+    )
+    assert not out.errors
+    assert (tmp_path / "small.txt").read_bytes() == b"small file"
+
+
+@pytest.mark.skipif(shutil.which("aws") is None, reason="The AWS CLI is not installed")
+def test_s3_cli_download_skips_up_to_date_files(monkeypatch, s3_datasets, tmp_path, capsys):
+    _, endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.S3_DATASETS_DIR_ENV_VAR, str(tmp_path / "downloads"))
+    symlink_datasets_and_caches.prepare_cred()
+    client = symlink_datasets_and_caches.get_s3_client(endpoint_url, "gcdata-r")
+    (file,) = [f for f in symlink_datasets_and_caches.list_files(client, "source") if f.s3file.endswith("test1.txt")]
+    target = pathlib.Path(file.local_file)
+
+    def download() -> bool:
+        """Returns whether the file was skipped"""
+        capsys.readouterr()
+        out = symlink_datasets_and_caches.download_file(
+            endpoint_url, "gcdata-r", file, max_concurrency=1, use_cli=True, max_attempts=1
+        )
+        assert not out.errors
+        return "Skipping" in capsys.readouterr().out
+
+    assert not download()
+    assert target.read_bytes() == b"test file 1"
+    # The CLI gives downloaded files the modification time of the object, the next run skips them
+    assert download()
+    # Only the size and modification time are compared
+    target.write_bytes(b"edited file")
+    os.utime(target, (file.last_modified, file.last_modified))
+    assert download()
+    assert target.read_bytes() == b"edited file"
+    # Files older than the object are downloaded again
+    os.utime(target, (file.last_modified - 60, file.last_modified - 60))
+    assert not download()
+    assert target.read_bytes() == b"test file 1"
+    # As are files with a different size
+    target.write_bytes(b"test")
+    assert not download()
+    assert target.read_bytes() == b"test file 1"
+
+
+@pytest.mark.skipif(shutil.which("aws") is None, reason="The AWS CLI is not installed")
+def test_copy_graphcore_s3_with_cli(monkeypatch, s3_datasets, settings_file, symlink_def, tmp_path):
+    config_file, endpoint_url = s3_datasets
+    monkeypatch.setenv(symlink_datasets_and_caches.AWS_ENDPOINT_ENV_VAR, endpoint_url)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    args = symlink_datasets_and_caches.symlink_arguments(argparse.ArgumentParser()).parse_args(
+        [
+            "--config-file",
+            str(config_file),
+            "--gradient-settings-file",
+            str(settings_file),
+            "--use-cli",
+            "--max-concurrency",
+            "16",
+            "--num-concurrent-downloads",
+            "2",
+        ]
+    )
+    symlink_datasets_and_caches.copy_graphcore_s3(args)
+    # Each CLI process gets the requested concurrency, not the total of all the concurrent downloads
+    assert "max_concurrent_requests = 16" in (tmp_path / "home" / ".aws" / "config").read_text()
+    ((target_dir, sources),) = symlink_def.items()
+    for source in sources:
+        for file in pathlib.Path(source).iterdir():
+            assert (pathlib.Path(target_dir) / file.name).read_bytes() == file.read_bytes()
+
+
+def test_prepare_cred_writes_cli_config(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    config_file = tmp_path / ".aws" / "config"
+    config_file.parent.mkdir()
+    config_file.write_text("[default]\nregion = eu-west-1\n")
+    # Below the CLI default, only the larger part size is written
+    symlink_datasets_and_caches.prepare_cred(cli_max_concurrent_requests=1)
+    config = config_file.read_text()
+    assert config.count("[profile gcdata-r]") == 1
+    assert "max_concurrent_requests" not in config
+    assert "multipart_chunksize = 16MB" in config
+    for _ in range(2):
+        symlink_datasets_and_caches.prepare_cred(cli_max_concurrent_requests=32)
+        config = config_file.read_text()
+        assert config.count("[profile gcdata-r]") == 1
+        assert "max_concurrent_requests = 32" in config
+    assert config.startswith("[default]\nregion = eu-west-1\n")
+
+
+@pytest.mark.parametrize(
+    "io_chunksize", [256 * 1024, symlink_datasets_and_caches.DEFAULT_IO_CHUNKSIZE, 512 * 1024**2]
+)
+def test_transfer_config_bounds_io_queue_memory(io_chunksize):
+    config = symlink_datasets_and_caches.build_transfer_config(4, io_chunksize=io_chunksize)
+    assert config.max_io_queue >= 1
+    assert config.max_io_queue * io_chunksize <= max(symlink_datasets_and_caches.IO_QUEUE_MEMORY_BUDGET, io_chunksize)
@@ -1,18 +1,25 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
-import os
-import nbformat
-from nbconvert import Exporter
-from nbconvert.exporters.exporter import ResourcesDict
-from nbconvert.preprocessors import CellExecutionError, ExecutePreprocessor
-from nbformat import NotebookNode
-from typing import Union, List
+import json
+import pathlib
+import shlex
+from typing import TYPE_CHECKING, Union, List
 import subprocess
 import warnings
 
+if TYPE_CHECKING:
+    from nbformat import NotebookNode
+
+REPO_ROOT = pathlib.Path(__file__).parents[1].resolve()
+TEST_FILES_DIR = REPO_ROOT / "tests" / "test_files"
+
 DEFAULT_PROCESS_TIMEOUT_SECONDS = 40 * 60
 
 DEFAULT_TIMEOUT = 600
 
+# Characters which need a shell to be interpreted, other string commands are tokenized with shlex.
+# This includes `=` for environment variable assignments and `#` for comments.
+SHELL_METACHARACTERS = frozenset("|&;<>$`*?(){}[]!~=#\\\"'\n")
+
 
 def run_notebook(notebook_filename: str, working_directory: str, timeout: int = DEFAULT_TIMEOUT) -> str:
     """Run a notebook and return all its outputs to stdstream together
@@ -22,57 +29,59 @@ def run_notebook(notebook_filename: str, working_directory: str, timeout: int =
         working_directory: The working directory from which the notebook is
             to be run.
     """
-
-    with open(notebook_filename) as f:
-        nb = nbformat.read(f, as_version=4)
+    # nbformat and nbconvert are slow to import, only load them for tests which run notebooks
+    import nbformat
+    from nbconvert.preprocessors import CellExecutionError, ExecutePreprocessor
+
+    # Skip nbformat's schema validation for v4 notebooks, the notebook is only executed
+    with open(notebook_filename, "rb") as f:
+        notebook_json = json.load(f)
+    if notebook_json.get("nbformat") == 4:
+        nb = nbformat.v4.to_notebook_json(notebook_json)
+    else:
+        nb = nbformat.read(notebook_filename, as_version=4)
     ep = ExecutePreprocessor(timeout=timeout, kernel_name="python3")
-    exporter = OutputExporter()
     try:
         ep.preprocess(nb, {"metadata": {"path": f"{working_directory}"}})
     except CellExecutionError:
-        output, _ = exporter.from_notebook_node(nb)
+        output = stream_outputs(nb)
         print(output)
         raise
-    output, _ = exporter.from_notebook_node(nb)
+    else:
+        output = stream_outputs(nb)
     return output
 
 
-class OutputExporter(Exporter):
-    """nbconvert Exporter to export notebook output as single string source code."""
-
-    # Extension of the file that should be written to disk (used by parent class)
-    file_extension = ".py"
-
-    def from_notebook_node(self, nb: NotebookNode, **kwargs):
-        notebook, _ = super().from_notebook_node(nb, **kwargs)
-        # notebooks are lists of cells, code cells are of the format:
-        # {"cell_type": "code",
-        #  "outputs":[
-        #     {
-        #         "output_type": "stream"|"bytes",
-        #         "text":"text of interest that we want to capture"
-        #     }, ...]}
-        # Hence the following list comprehension:
-        cell_outputs = [
-            output.get("text", "") + os.linesep
-            for cell in notebook.cells
-            if cell.cell_type == "code"
-            for output in cell.outputs
-            if output
-            if output.get("output_type") == "stream"
-        ]
-
-        outputs = os.linesep.join(cell_outputs)
-
-        return outputs, ResourcesDict()
+def stream_outputs(nb: "NotebookNode") -> str:
+    """Collects the stream outputs of the code cells of an executed notebook in a single string"""
+    # notebooks are lists of cells, code cells are of the format:
+    # {"cell_type": "code",
+    #  "outputs":[
+    #     {
+    #         "output_type": "stream"|"bytes",
+    #         "text":"text of interest that we want to capture"
+    #     }, ...]}
+    # Hence the following generator, joined in a single pass. Lines are separated with "\n"
+    # as in the notebook text itself, text mode streams translate it if the platform needs it.
+    return "\n".join(
+        output.get("text", "") + "\n"
+        for cell in nb.cells
+        if cell.cell_type == "code"
+        for output in cell.outputs
+        if output
+        if output.get("output_type") == "stream"
+    )
 
 
 class CalledProcessError(subprocess.CalledProcessError):
     """An error for subprocesses which captures stdout and stderr in the error message."""
 
     def __str__(self) -> str:
-        original_message = super().__str__()
-        return f"{original_message}\n" f"{self.stdout}\n" f"{self.stderr}"
+        parts = [super().__str__()]
+        for stream in (self.stdout, self.stderr):
+            if stream:
+                parts.append(stream.decode("utf-8", errors="ignore") if isinstance(stream, bytes) else stream)
+        return "\n".join(parts)
 
 
 def run_command_fail_explicitly(
@@ -86,6 +95,8 @@ def run_command_fail_explicitly(
 
     Args:
         command: The command to execute, can also be a space separated string.
+            Strings are only run through a shell if they contain shell
+            metacharacters.
         cwd: The directory in which the command should be
             launched. If called by a pytest test function or method, this
             probably should be a `tmp_path` fixture.
@@ -93,7 +104,7 @@ def run_command_fail_explicitly(
                            parsed more reliably. Will still be captured if
                            command raises an exception.
         **kwargs: Additional keyword arguments are passed to
-            `subprocess.check_output`.
+            `subprocess.run`.
 
     Returns:
         The standard output and error of the command if successfully executed.
@@ -115,8 +126,14 @@ def run_command_fail_explicitly(
         # PIPE rather None, so we can still access from exceptions below
         kwargs["stderr"] = subprocess.PIPE
 
+    needs_shell = isinstance(command, str) and any(c in SHELL_METACHARACTERS for c in command)
+    args = command
+    if isinstance(command, str) and not needs_shell and "shell" not in kwargs:
+        args = shlex.split(command)
+
     DEFAULT_KWARGS = {
-        "shell": isinstance(command, str) and " " in command,
+        "shell": needs_shell,
+        "stdout": subprocess.PIPE,
         "stderr": subprocess.STDOUT,
         "timeout": DEFAULT_PROCESS_TIMEOUT_SECONDS,
         "universal_newlines": True,
@@ -124,20 +141,15 @@ def run_command_fail_explicitly(
 
     try:
         merged_kwargs = {**DEFAULT_KWARGS, **kwargs}
-        out = subprocess.check_output(
-            command,
-            cwd=cwd,
-            **merged_kwargs,
-        )
+        completed = subprocess.run(args, cwd=cwd, check=True, **merged_kwargs)
     except subprocess.CalledProcessError as e:
         stdout = e.stdout
         stderr = e.stderr
-        # type of the stdout stream will depend on the subprocess.
-        # The python docs say decoding is to be handled at
-        # application level.
+        # Streams are only decoded by the subprocess module in text mode,
+        # callers may override `universal_newlines` to get bytes.
         if hasattr(stdout, "decode"):
             stdout = stdout.decode("utf-8", errors="ignore")
         if hasattr(stderr, "decode"):
             stderr = stderr.decode("utf-8", errors="ignore")
-        raise CalledProcessError(1, cmd=command, output=stdout, stderr=stderr) from e
-    return out
+        raise CalledProcessError(e.returncode, cmd=command, output=stdout, stderr=stderr) from e
+    return completed.stdout